@@ -0,0 +1,209 @@
+"""
+Image download plumbing shared by dailymail.py and guardian.py: the copy
+arena, the ETag/Last-Modified cache, the HEAD probe, the conditional GET and
+the per-run queue that hands finished pages back in URL order. The scrapers
+only decide file names and what to print.
+"""
+import itertools
+import os
+import shutil
+import sqlite3
+import threading
+import urllib.error
+from collections import deque
+from concurrent.futures import wait
+
+from _http import open_url
+
+COPY_CHUNK = 64 * 1024  # streaming buffer per download
+ARENA_SLOTS = 16        # one per download worker (DOWNLOAD_WORKERS in both scripts)
+
+# one COPY_CHUNK slot per download worker, carved out of a single allocation
+_ARENA = memoryview(bytearray(COPY_CHUNK * ARENA_SLOTS))
+_arena_slots = itertools.count()
+_worker = threading.local()
+
+def copy_response(r, f):
+    """Stream an HTTP response into f via this thread's arena slot (readinto, no per-chunk bytes)."""
+    buf = getattr(_worker, "buf", None)
+    if buf is None:
+        off = next(_arena_slots) * COPY_CHUNK
+        # threads beyond the pool size get a private buffer
+        buf = _ARENA[off:off + COPY_CHUNK] if off < len(_ARENA) else memoryview(bytearray(COPY_CHUNK))
+        _worker.buf = buf
+    while True:
+        n = r.readinto(buf)
+        if not n:
+            break
+        f.write(buf[:n])
+    # unlike read(), readinto() just returns 0 when the peer hangs up early
+    if r.length:
+        raise ConnectionError(f"connection closed with {r.length} bytes of the body missing")
+
+class ValidatorCache:
+    """
+    url -> (file, ETag, Last-Modified) from earlier runs, kept in sqlite so an
+    unchanged image is answered with 304 Not Modified instead of a full body.
+    """
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS images "
+                             "(url TEXT PRIMARY KEY, path TEXT, etag TEXT, last_modified TEXT)")
+
+    def lookup(self, url: str):
+        """(path, etag, last_modified) if url was saved before and the file is still there."""
+        with self._lock:
+            row = self._db.execute("SELECT path, etag, last_modified FROM images WHERE url = ?",
+                                   (url,)).fetchone()
+        if row and os.path.exists(row[0]) and (row[1] or row[2]):
+            return row
+        return None
+
+    def store(self, url: str, path: str, etag: str | None, last_modified: str | None):
+        with self._lock, self._db:
+            # whatever used to live at path has been overwritten
+            self._db.execute("DELETE FROM images WHERE path = ? AND url != ?", (path, url))
+            self._db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+                             (url, path, etag, last_modified))
+
+    def close(self):
+        self._db.close()
+
+class Skipped(Exception):
+    """The HEAD probe says the URL is not worth downloading; str() says why."""
+
+def probe(url: str, headers: dict, min_bytes: int) -> str | None:
+    """HEAD the image; return why it should be skipped, or None to download it."""
+    try:
+        with open_url(url, method="HEAD", headers=headers, timeout=15) as r:
+            ctype = r.headers.get("Content-Type")
+            length = r.headers.get("Content-Length")
+    except urllib.error.HTTPError as e:
+        if e.code in (405, 501):  # HEAD not supported; let the GET decide
+            return None
+        return f"HTTP {e.code}"
+    except Exception:
+        return None
+    if ctype and not ctype.lower().startswith("image/"):
+        return f"not an image ({ctype})"
+    if length and length.isdigit() and int(length) < min_bytes:
+        return f"too small ({length} bytes)"
+    return None
+
+def _get(url: str, path: str, headers: dict) -> tuple[str | None, str | None]:
+    # stream socket -> file, never holding the whole image in memory
+    with open_url(url, headers=headers, timeout=30) as r, open(path, "wb") as f:
+        copy_response(r, f)
+        return r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+def download(url: str, path: str, cached, headers: dict, min_bytes: int, on_refetch=None):
+    """
+    Download url to path; returns its (ETag, Last-Modified) validators.
+
+    cached is ValidatorCache.lookup(url). With it the GET is conditional and a
+    304 is answered by copying that file; if the copy fails, on_refetch(error)
+    is told and the image is downloaded again. Without it, the HEAD probe runs
+    first and raises Skipped on a rejection. Any other error is re-raised once
+    the partial file at path is removed.
+    """
+    try:
+        if not cached:
+            reason = probe(url, headers, min_bytes)
+            if reason:
+                raise Skipped(reason)
+            return _get(url, path, headers)
+        cached_path, etag, last_modified = cached
+        conditional = dict(headers)
+        if etag:
+            conditional["If-None-Match"] = etag
+        if last_modified:
+            conditional["If-Modified-Since"] = last_modified
+        try:
+            return _get(url, path, conditional)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+        # unchanged since the last run: reuse the local copy, if it is still readable
+        try:
+            shutil.copyfile(cached_path, path)
+            return etag, last_modified
+        except OSError as e:
+            if on_refetch:
+                on_refetch(e)
+        return _get(url, path, headers)
+    except Skipped:
+        raise
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+REPEAT = object()  # outcome of an image URL first queued for an earlier page
+
+class Downloads:
+    """
+    One run's download queue. Each image URL is handed to job(url, tmp, cached)
+    on the pool once, writing a temporary file in outdir; finished() returns
+    pages in URL order and keep() gives a download its final name. seen maps
+    every kept (or otherwise named) URL to its file name for later pages.
+
+    Lookups, renames and cache writes all happen on the caller's thread. A 304
+    job may still be copying a cached file, so keep() waits for those jobs
+    before replacing it.
+    """
+    def __init__(self, pool, cache: ValidatorCache, outdir: str, prefix: str, job):
+        self.seen: dict[str, str] = {}
+        self._pool, self._cache, self._outdir, self._prefix, self._job = pool, cache, outdir, prefix, job
+        self._submitted: set[str] = set()
+        self._readers: dict[str, set] = {}  # cached file -> queued jobs that may copy it
+        self._pending = deque()             # (page, jobs) not handed back yet, in URL order
+        self._page_no = itertools.count()
+
+    def submit(self, page, urls):
+        """Queue one page's image URLs under temporary names."""
+        page_no = next(self._page_no)
+        jobs = []
+        for i, url in enumerate(urls):
+            if url in self._submitted:
+                jobs.append((url, None, None, None))
+                continue
+            self._submitted.add(url)
+            tmp = os.path.join(self._outdir, f".{self._prefix}_{page_no}_{i}.part")
+            cached = self._cache.lookup(url)
+            fut = self._pool.submit(self._job, url, tmp, cached)
+            if cached:
+                self._readers.setdefault(cached[0], set()).add(fut)
+            jobs.append((url, tmp, fut, cached and cached[0]))
+        self._pending.append((page, jobs))
+
+    def finished(self, block: bool = False):
+        """
+        Yield (page, [(url, tmp, outcome), ...]) for each leading page whose
+        downloads are all done, or for every page left if block. outcome is
+        what job returned, or REPEAT (the name, if any, is in seen by now).
+        """
+        while self._pending and (block or all(fut.done() for _, _, fut, _ in self._pending[0][1] if fut)):
+            page, jobs = self._pending.popleft()
+            results = []
+            for url, tmp, fut, cached_path in jobs:
+                if fut is None:
+                    results.append((url, None, REPEAT))
+                    continue
+                outcome = fut.result()
+                readers = self._readers.get(cached_path)
+                if readers is not None:
+                    readers.discard(fut)
+                    if not readers:
+                        del self._readers[cached_path]
+                results.append((url, tmp, outcome))
+            yield page, results
+
+    def keep(self, url: str, tmp: str, validators, name: str):
+        """Move a finished download to outdir/name and remember its validators."""
+        path = os.path.join(self._outdir, name)
+        wait(self._readers.pop(path, ()))
+        os.replace(tmp, path)
+        self._cache.store(url, path, *validators)  # also drops the stale entry for path, so no new reader
+        self.seen[url] = name
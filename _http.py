@@ -0,0 +1,103 @@
+"""
+Keep-alive HTTP shared by dailymail.py and guardian.py.
+
+urllib.request opens (and TLS-handshakes) a fresh connection for every
+request, so each image cost two: one for the HEAD probe, one for the GET.
+Here every worker thread keeps one http.client connection per host and
+reuses it for its pages, probes and downloads; close_all() shuts them at the
+end of a run. Unlike urlopen(), no proxy is used: the *_proxy environment
+variables are ignored.
+"""
+import contextlib
+import http.client
+import threading
+import urllib.error
+import urllib.parse
+
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+
+# a kept-alive socket the server has since closed; the request is sent again once
+STALE = (http.client.RemoteDisconnected, http.client.ImproperConnectionState,
+         ConnectionResetError, BrokenPipeError)
+
+# (thread id, scheme, netloc) -> connection; only its own thread ever uses one,
+# the lock guards the dict so close_all() can reach every thread's sockets
+_conns: dict = {}
+_lock = threading.Lock()
+
+def _connection(key, timeout: float):
+    key = (threading.get_ident(), *key)
+    with _lock:
+        conn = _conns.get(key)
+        if conn is None:
+            _, scheme, netloc = key
+            cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            conn = _conns[key] = cls(netloc, timeout=timeout)
+    return conn
+
+def _discard(key):
+    with _lock:
+        conn = _conns.pop((threading.get_ident(), *key), None)
+    if conn is not None:
+        conn.close()
+
+def close_all():
+    """Close every kept-alive connection; call once the worker pools are done."""
+    with _lock:
+        conns = list(_conns.values())
+        _conns.clear()
+    for conn in conns:
+        conn.close()
+
+def _request(key, method: str, target: str, headers: dict, timeout: float):
+    for attempt in (1, 2):
+        conn = _connection(key, timeout)
+        try:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            conn.request(method, target, headers=headers)
+            return conn.getresponse()
+        except STALE:
+            _discard(key)
+            if attempt == 2:
+                raise
+        except BaseException:
+            _discard(key)
+            raise
+
+@contextlib.contextmanager
+def open_url(url: str, method: str = "GET", headers=None, timeout: float = 30):
+    """
+    urlopen() over this thread's kept-alive connection: yields the
+    http.client.HTTPResponse. Redirects are followed; any other status >= 300
+    (304 included) raises urllib.error.HTTPError, as urlopen does.
+    """
+    headers = headers or {}
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        resp = _request(key, method, target, headers, timeout)
+        if resp.status < 300:
+            break
+        resp.read()  # drain the (small) error/redirect body so the connection stays usable
+        location = resp.getheader("Location")
+        if resp.status not in REDIRECTS or not location:
+            raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+        url = urllib.parse.urljoin(url, location)
+        if resp.status == 303:
+            method = "GET"
+    else:
+        raise urllib.error.HTTPError(url, resp.status, "too many redirects", resp.headers, None)
+
+    try:
+        yield resp
+    except BaseException:
+        _discard(key)
+        raise
+    if resp.length == 0:
+        resp.read()  # HEAD or empty body: only read() hands the connection back
+    if not resp.isclosed():  # body left unread: the connection cannot be reused
+        _discard(key)
@@ -0,0 +1,61 @@
+"""
+srcset helpers shared by dailymail.py and guardian.py.
+
+Candidates are ranked in one streaming pass: any width descriptor (300w)
+beats any density descriptor (2x), which beats a plain URL. Ties keep the
+earliest candidate. No (url, width, density) lists are built.
+"""
+import functools
+import itertools
+import re
+import urllib.parse
+
+# one "<url> <n>w" / "<url> <n>x" candidate per match; the URL must start a token
+SRCSET_CAND = re.compile(r"(?:^|(?<=[\s,]))([^\s,]+)\s+(?:(\d+)[wW]|(\d*\.?\d+)[xX])(?=[\s,]|$)")
+
+@functools.lru_cache(maxsize=4096)
+def abs_url(base_url: str, u: str) -> str:
+    """urljoin, memoised; already-absolute http(s) URLs are returned as-is."""
+    if u.startswith(("http://", "https://")):
+        return u
+    return urllib.parse.urljoin(base_url, u)  # relative or protocol-relative (//host/...)
+
+def srcset_iter_best(srcsets, base_url: str, urls=(), score=None):
+    """
+    Overall winner across several srcset strings (e.g. every <source> of a
+    <picture> plus the <img> itself) and plain fallback URLs (src, data-src...).
+    Empty/None entries are skipped. Plain URLs, and srcsets without any
+    descriptor, are ranked by score(url) if given, else the first one wins.
+    Returns (absolute url, width or density), or (None, None).
+    """
+    best_url, best_key = None, None
+    plain = []  # descriptor-less srcsets, only looked at if nothing better shows up
+    for srcset in srcsets:
+        if not srcset:
+            continue
+        found = False
+        for m in SRCSET_CAND.finditer(srcset):
+            found = True
+            w = m.group(2)
+            key = (2, int(w)) if w is not None else (1, float(m.group(3)))
+            if best_key is None or key > best_key:
+                best_url, best_key = m.group(1), key
+        if not found:
+            plain.append(srcset)
+
+    if best_key is None:
+        plain_urls = (u for ss in plain for part in ss.split(",") for u in part.split()[:1])
+        for u in itertools.chain(plain_urls, urls):
+            if not u:
+                continue
+            key = (0, score(u) if score else 0)
+            if best_key is None or key > best_key:
+                best_url, best_key = u, key
+
+    if best_url is None:
+        return None, None
+    return abs_url(base_url, best_url), (best_key[1] if best_key[0] else None)
+
+def srcset_best(srcset, base_url: str, score=None):
+    """Largest candidate of a single srcset string: (absolute url, width or density)."""
+    return srcset_iter_best((srcset,), base_url, score=score)
@@ -7,21 +7,36 @@ Daily Mail scraper (image-wrap only)
 - Variant: choose the largest from srcset/data-srcset (including <picture><source>), else fallback
 - Save: dailymail_1.jpg, dailymail_2.webp, ... (sequential across all URLs, extensions preserved; default .jpg)
 - Log: dailymail_log.csv with columns: URL, Number of Images, Image 1 Name, Image 2 Name, ...
+- Network: direct keep-alive connections only; HTTP(S)_PROXY / http_proxy and friends are NOT honoured
 
 Usage:
   python3 dailymail_imagewrap.py
 """
 
-import os, sys, csv, re
-from html.parser import HTMLParser
-from urllib.parse import urljoin, urlparse
-from urllib.request import Request, urlopen, urlretrieve
+import os, sys, csv, re, html, codecs, functools, itertools
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from _download import REPEAT, Downloads, Skipped, ValidatorCache, download
+from _http import close_all, open_url
+from _srcset import srcset_iter_best
+
+# HTML back ends, fastest first: selectolax (lexbor), lxml, then the regex sweep
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
 
 # ---------- paths (current working directory) ----------
 BASEDIR = os.getcwd()
 URLFILE = os.path.join(BASEDIR, "dailymail_urls.txt")
 OUTDIR  = os.path.join(BASEDIR, "dailymail_images")
 LOGCSV  = os.path.join(BASEDIR, "dailymail_log.csv")
+CACHEDB = os.path.join(BASEDIR, "dailymail_cache.sqlite")  # ETag/Last-Modified per image URL
 os.makedirs(OUTDIR, exist_ok=True)
 
 print(f"[pwd] {BASEDIR}\n[in ] {URLFILE}\n[out] {OUTDIR}\n[log] {LOGCSV}")
@@ -29,37 +44,21 @@ print(f"[pwd] {BASEDIR}\n[in ] {URLFILE}\n[out] {OUTDIR}\n[log] {LOGCSV}")
 UA = ("Mozilla/5.0 (Macintosh; Intel Mac OS X) "
       "AppleWebKit/537.36 (KHTML, like Gecko) Chrome Safari")
 
+FETCH_WORKERS = 16     # article pages fetched concurrently
+DOWNLOAD_WORKERS = 16  # image downloads in flight
+MIN_IMAGE_BYTES = 20000  # HEAD Content-Length below this: thumbnail / pixel, skipped
+
 IMG_EXT_RE = re.compile(r'\.(jpg|jpeg|png|webp)(?:$|\?)', re.IGNORECASE)
 SIZE_IN_NAME_RE = re.compile(r'(?<!\d)(\d{3,5})[xX](\d{3,5})(?!\d)')  # e.g., 1200x800
 
-def _parse_srcset(srcset: str):
-    """Return list of (url, width, density) from a srcset string."""
-    out = []
-    if not srcset:
-        return out
-    for part in srcset.split(','):
-        token = part.strip()
-        if not token:
-            continue
-        bits = token.split()
-        url = bits[0]
-        width = None
-        density = None
-        if len(bits) > 1:
-            desc = bits[1].lower()
-            if desc.endswith('w'):
-                try:
-                    width = int(desc[:-1])
-                except ValueError:
-                    width = None
-            elif desc.endswith('x'):
-                try:
-                    density = float(desc[:-1])
-                except ValueError:
-                    density = None
-        out.append((url, width, density))
-    return out
+# regex sweep used when no HTML library is available; runs on the raw body bytes
+DIV_TAG_RE   = re.compile(rb'<(/?)div\b([^>]*)>', re.IGNORECASE)
+MEDIA_TAG_RE = re.compile(rb'<(/?)(picture|source|img)\b([^>]*)>', re.IGNORECASE)
+# comments and raw script/style text are not markup; blanked before the sweep
+SKIP_RE      = re.compile(rb'<!--.*?-->|<(script|style)\b.*?</\1\s*>', re.S | re.I)
+ATTR_RE      = re.compile(rb'''([\w:-]+)\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)''')
 
+@functools.lru_cache(maxsize=2048)
 def _score_url(u: str):
     """Heuristic when no descriptors: prefer bigger WxH in filename; else longer URL."""
     m = SIZE_IN_NAME_RE.search(u)
@@ -68,21 +67,7 @@ def _score_url(u: str):
         return w * h
     return len(u)
 
-def _pick_largest(candidates, base_url: str) -> str | None:
-    """Pick the best absolute URL from candidates"""
-    if not candidates:
-        return None
-    with_w = [c for c in candidates if c[1] is not None]
-    if with_w:
-        url, _, _ = max(with_w, key=lambda c: c[1])
-        return urljoin(base_url, url)
-    with_x = [c for c in candidates if c[2] is not None]
-    if with_x:
-        url, _, _ = max(with_x, key=lambda c: c[2])
-        return urljoin(base_url, url)
-    url = max((c[0] for c in candidates), key=_score_url)
-    return urljoin(base_url, url)
-
+@functools.lru_cache(maxsize=2048)
 def _ext_from_url(u: str) -> str:
     path = urlparse(u).path
     name = os.path.basename(path)
@@ -95,109 +80,201 @@ def _ext_from_url(u: str) -> str:
             return "." + ext
     return ".jpg"
 
-class DMImageWrapParser(HTMLParser):
+def _best_img_url(at, picture_srcsets, base_url: str) -> str | None:
+    """
+    Best absolute URL for one <img>, given its attributes and the enclosing
+    <picture> srcset strings: width descriptors first, then density, then
+    the plain data-src/src URLs (ranked by _score_url).
     """
-    Only collect images while inside <div class="image-wrap"> (nested allowed).
-    Capture <picture><source> srcsets to inform the subsequent <img> choice.
+    srcsets = itertools.chain(picture_srcsets, (at.get('srcset'), at.get('data-srcset')))
+    urls = (at.get(key) for key in ('data-src', 'data-original', 'data-image', 'src'))
+    return srcset_iter_best(srcsets, base_url, urls=urls, score=_score_url)[0]
+
+def _attrs(raw: bytes, charset: str) -> dict:
+    """Attribute dict from the inside of a start tag (names lower-cased, values decoded + unescaped)."""
+    at = {}
+    for m in ATTR_RE.finditer(raw):
+        v = m.group(2)
+        if v[:1] in (b'"', b"'"):
+            v = v[1:-1]
+        v = v.decode(charset, errors='replace')
+        at[m.group(1).decode('ascii').lower()] = html.unescape(v) if '&' in v else v
+    return at
+
+def _image_wrap_spans(body: bytes, charset: str) -> list[tuple[int, int]]:
+    """(start, end) offsets of the body of every outermost <div class="image-wrap">."""
+    spans = []
+    depth = 0  # div nesting inside the current image-wrap
+    start = 0
+    for m in DIV_TAG_RE.finditer(body):
+        if depth:
+            depth += -1 if m.group(1) else 1
+            if not depth:
+                spans.append((start, m.start()))
+        elif (not m.group(1) and b'image-wrap' in m.group(2)
+              and 'image-wrap' in (_attrs(m.group(2), charset).get('class') or '').split()):
+            depth = 1
+            start = m.end()
+    if depth:  # unclosed wrap runs to the end of the document
+        spans.append((start, len(body)))
+    return spans
+
+def _extract_regex(body: bytes, charset: str, base_url: str) -> list[str]:
     """
-    def __init__(self, base_url: str):
-        super().__init__(convert_charrefs=True)
-        self.base_url = base_url
-        self.imgs: list[str] = []
-        self.stack_in_wrap: list[bool] = []
-        self.stack_in_picture: list[bool] = []
-        self.current_picture_srcsets: list[tuple[str, int|None, float|None]] = []
-
-    def handle_starttag(self, tag, attrs):
-        tl = tag.lower()
-        at = dict(attrs)
-
-        if tl == 'div':
-            cls = at.get('class', '') or ''
-            # class may contain multiple; match token
-            classes = cls.split()
-            in_wrap = 'image-wrap' in classes
-            self.stack_in_wrap.append(in_wrap or (self.stack_in_wrap[-1] if self.stack_in_wrap else False))
-
-        elif tl == 'picture':
-            self.stack_in_picture.append(True)
-            self.current_picture_srcsets = []
-
-        elif tl == 'source' and (self.stack_in_picture[-1] if self.stack_in_picture else False):
-            ss = at.get('srcset') or at.get('data-srcset')
-            if ss:
-                self.current_picture_srcsets.extend(_parse_srcset(ss))
-
-        elif tl == 'img':
-            in_wrap_now = self.stack_in_wrap[-1] if self.stack_in_wrap else False
-            if not in_wrap_now:
-                return
-
-            candidates = []
-            # from surrounding <picture><source>
-            if self.stack_in_picture and self.current_picture_srcsets:
-                candidates.extend(self.current_picture_srcsets)
-
-            # from img srcset attributes
-            for key in ('srcset', 'data-srcset'):
-                if at.get(key):
-                    candidates.extend(_parse_srcset(at[key]))
-
-            # fallback single URLs
-            for key in ('data-src', 'data-original', 'data-image', 'src'):
-                if at.get(key):
-                    candidates.append((at[key], None, None))
-
-            if not candidates:
-                return
-
-            best = _pick_largest(candidates, self.base_url)
-            if not best:
-                return
-
-            self.imgs.append(best)
-
-    def handle_endtag(self, tag):
-        tl = tag.lower()
-        if tl == 'div':
-            if self.stack_in_wrap:
-                self.stack_in_wrap.pop()
-        elif tl == 'picture':
-            if self.stack_in_picture:
-                self.stack_in_picture.pop()
-            self.current_picture_srcsets = []
-
-def fetch_html(url: str) -> str:
-    req = Request(url, headers={'User-Agent': UA})
-    with urlopen(req, timeout=60) as resp:
-        return resp.read().decode('utf-8', errors='replace')
+    Only collect images inside <div class="image-wrap"> (nested allowed).
+    <picture><source> srcsets inform the subsequent <img> choice.
+    Stdlib fallback: no full parse, just a sweep of the image-wrap byte ranges.
+    """
+    body = SKIP_RE.sub(b'', body)
+    imgs = []
+    for start, end in _image_wrap_spans(body, charset):
+        picture_depth = 0
+        picture_srcsets = []
+        for m in MEDIA_TAG_RE.finditer(body, start, end):
+            closing, tag, raw = m.groups()
+            tag = tag.lower()
+            if tag == b'picture':
+                if closing:
+                    picture_depth = max(picture_depth - 1, 0)
+                else:
+                    picture_depth += 1
+                picture_srcsets = []
+            elif closing:
+                continue
+            elif tag == b'source':
+                if picture_depth:
+                    at = _attrs(raw, charset)
+                    ss = at.get('srcset') or at.get('data-srcset')
+                    if ss:
+                        picture_srcsets.append(ss)
+            else:
+                best = _best_img_url(_attrs(raw, charset), picture_srcsets if picture_depth else (), base_url)
+                if best:
+                    imgs.append(best)
+    return imgs
+
+def fetch_html(url: str) -> tuple[bytes, str]:
+    """Raw body plus its charset: Content-Type's, else UTF-8 (as the pages were always decoded)."""
+    with open_url(url, headers={'User-Agent': UA}, timeout=60) as resp:
+        charset = resp.headers.get_content_charset()
+        body = resp.read()
+    if charset:
+        try:
+            codecs.lookup(charset)
+        except LookupError:  # bogus header
+            charset = None
+    return body, charset or 'utf-8'
+
+# every <img> below a <div class="image-wrap"> (class matched as a token), in document order
+IMAGE_WRAP_IMG_XPATH = ('//div[contains(concat(" ", normalize-space(@class), " "), " image-wrap ")]'
+                        '//img')
+
+def _extract_lxml(body: bytes, charset: str, base_url: str) -> list[str]:
+    """Same selection as _extract_regex, but tokenised and scoped by libxml2 (decodes the bytes itself)."""
+    try:
+        parser = lxml_html.HTMLParser(encoding=charset, huge_tree=True)
+    except LookupError:  # a codec name Python knows but libxml2 does not
+        parser = lxml_html.HTMLParser(encoding='utf-8', huge_tree=True)
+    tree = lxml_html.document_fromstring(body, parser=parser)
+    imgs = []
+    for img in tree.xpath(IMAGE_WRAP_IMG_XPATH):
+        picture_srcsets = []
+        pic = next(img.iterancestors('picture'), None)
+        if pic is not None:
+            # only the <source>s before this <img>, as in the regex sweep
+            for el in pic.iter('source', 'img'):
+                if el is img:
+                    break
+                if el.tag == 'source':
+                    ss = el.get('srcset') or el.get('data-srcset')
+                    if ss:
+                        picture_srcsets.append(ss)
+        best = _best_img_url(img.attrib, picture_srcsets, base_url)
+        if best:
+            imgs.append(best)
+    return imgs
+
+def _extract_lexbor(body: bytes, charset: str, base_url: str) -> list[str]:
+    """Same selection as _extract_regex, via lexbor's C tokenizer and CSS engine."""
+    # lexbor reads bytes as UTF-8; anything else is decoded first
+    if charset.lower() not in ('utf-8', 'utf8'):
+        body = body.decode(charset, errors='replace')
+    tree = LexborHTMLParser(body)
+    imgs = []
+    for img in tree.css('div.image-wrap img'):
+        picture_srcsets = []
+        pic = img.parent
+        while pic is not None and pic.tag != 'picture':
+            pic = pic.parent
+        if pic is not None:
+            # only the <source>s before this <img> (document order), as in the regex sweep
+            for el in pic.traverse():
+                if el.mem_id == img.mem_id:
+                    break
+                if el.tag == 'source':
+                    ss = el.attrs.get('srcset') or el.attrs.get('data-srcset')
+                    if ss:
+                        picture_srcsets.append(ss)
+        best = _best_img_url(img.attrs, picture_srcsets, base_url)
+        if best:
+            imgs.append(best)
+    return imgs
 
 def extract_image_urls(url: str) -> list[str]:
-    html_text = fetch_html(url)
-    parser = DMImageWrapParser(url)
-    parser.feed(html_text)
+    body, charset = fetch_html(url)
+    if LexborHTMLParser is not None:
+        imgs = _extract_lexbor(body, charset, url)
+    elif lxml_html is not None:
+        imgs = _extract_lxml(body, charset, url)
+    else:
+        imgs = _extract_regex(body, charset, url)
     # de-duplicate preserving order
     seen = set()
     out = []
-    for u in parser.imgs:
+    for u in imgs:
         if u not in seen:
             seen.add(u)
             out.append(u)
     return out
 
-def download_images_sequential(urls: list[str], outdir: str, start_index: int):
+def _extract_or_empty(url: str) -> list[str]:
+    """Worker for the page pool: fetch + parse, never raises."""
+    try:
+        return extract_image_urls(url)
+    except Exception as e:
+        print(f"[error] {url}: {e}")
+        return []
+
+def download_image(u: str, path: str, cached):
+    """Download worker: u's (ETag, Last-Modified) validators, or None if nothing was saved."""
+    def refetch(e):
+        print(f"[warn] cached copy of {u} unusable ({e}), downloading again")
+    try:
+        return download(u, path, cached, {'User-Agent': UA}, MIN_IMAGE_BYTES, refetch)
+    except Skipped as e:
+        print(f"[skip] {u}: {e}")
+    except Exception as e:
+        print(f"[warn] failed {u}: {e}")
+    return None
+
+def finish_downloads(results, start_index: int, downloads: Downloads):
+    """
+    Rename successful downloads to dailymail_<n><ext>, sequential in URL order.
+    Repeats of an image saved for an earlier page reuse its file name.
+    """
     saved = []
     idx = start_index
-    for u in urls:
-        ext = _ext_from_url(u)
-        fname = f"dailymail_{idx}{ext}"
-        full = os.path.join(outdir, fname)
-        try:
-            urlretrieve(u, full)
-            saved.append(fname)
-            idx += 1
-        except Exception as e:
-            print(f"[warn] failed {u}: {e}")
+    for u, tmp, validators in results:
+        if validators is REPEAT:
+            if u in downloads.seen:
+                saved.append(downloads.seen[u])
+            continue
+        if validators is None:
+            continue
+        fname = f"dailymail_{idx}{_ext_from_url(u)}"
+        downloads.keep(u, tmp, validators, fname)
+        saved.append(fname)
+        idx += 1
     return saved, idx
 
 def main():
@@ -208,33 +285,49 @@ def main():
     with open(URLFILE, "r", encoding="utf-8") as f:
         urls = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
 
-    rows = []
     max_imgs_any = 0
     global_index = 1
 
-    for u in urls:
-        print(f"\n[fetch] {u}")
-        try:
-            img_urls = extract_image_urls(u)
-        except Exception as e:
-            print(f"[error] {u}: {e}")
-            img_urls = []
-
-        print(f"[found] {len(img_urls)} images in image-wrap")
-        saved, global_index = download_images_sequential(img_urls, OUTDIR, global_index)
-        print(f"[saved] {len(saved)} images")
-
-        max_imgs_any = max(max_imgs_any, len(saved))
-        rows.append([u, len(saved), *saved])
-
-    # write CSV log
+    # pages are fetched concurrently (results come back in URL order) while the
+    # images of already-parsed pages download in a second pool; each image URL
+    # is downloaded once per run and later pages point at its file name
+    cache = ValidatorCache(CACHEDB)
+
+    def flush(block: bool):
+        # rows go out in URL order, as soon as a page and all pages before it are done
+        nonlocal global_index, max_imgs_any
+        for u, results in downloads.finished(block):
+            saved, global_index = finish_downloads(results, global_index, downloads)
+            print(f"[saved] {len(saved)} images <- {u}")
+            max_imgs_any = max(max_imgs_any, len(saved))
+            rows.writerow([u, len(saved), *saved])
+
+    spool = LOGCSV + ".part"  # unpadded rows, written page by page
+    with open(spool, "w", newline="", encoding="utf-8") as part, \
+         ThreadPoolExecutor(FETCH_WORKERS) as page_pool, \
+         ThreadPoolExecutor(DOWNLOAD_WORKERS) as dl_pool:
+        rows = csv.writer(part)
+        downloads = Downloads(dl_pool, cache, OUTDIR, "dailymail", download_image)
+        for u, img_urls in zip(urls, page_pool.map(_extract_or_empty, urls)):
+            print(f"\n[fetch] {u}")
+            print(f"[found] {len(img_urls)} images in image-wrap")
+            downloads.submit(u, img_urls)
+            flush(block=False)
+        flush(block=True)
+    close_all()
+    cache.close()
+
+    # write CSV log: the header width is only known now, so rows are copied
+    # over from the spool and padded lazily
     header = ["URL", "Number of Images"] + [f"Image {i} Name" for i in range(1, max_imgs_any + 1)]
-    with open(LOGCSV, "w", newline="", encoding="utf-8") as f:
+    width = len(header)
+    with open(spool, "r", newline="", encoding="utf-8") as part, \
+         open(LOGCSV, "w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
         w.writerow(header)
-        for r in rows:
-            r = r + [""] * (2 + max_imgs_any - len(r))
-            w.writerow(r)
+        for r in csv.reader(part):
+            w.writerow(itertools.chain(r, itertools.repeat("", width - len(r))))
+    os.remove(spool)
 
     print(f"\n[done] wrote log: {LOGCSV}")
 
@@ -1,17 +1,29 @@
 #!/usr/bin/env python3
 import os
+import functools
 import csv
+import codecs
+import itertools
 import re
-import html
 import html.parser
-import urllib.request
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from _download import REPEAT, Downloads, Skipped, ValidatorCache, download
+from _http import close_all, open_url
+from _srcset import abs_url, srcset_best
+
+try:
+    from lxml import html as lxml_html
+except ImportError:  # fall back to the stdlib parser below
+    lxml_html = None
 
 # ---------- paths (use the directory you run it from) ----------
 BASEDIR = os.getcwd()
 URLFILE = os.path.join(BASEDIR, "guardian_urls.txt")
 OUTDIR  = os.path.join(BASEDIR, "guardian_images")
 LOGCSV  = os.path.join(BASEDIR, "guardian_log.csv")
+CACHEDB = os.path.join(BASEDIR, "guardian_cache.sqlite")  # ETag/Last-Modified per image URL
 os.makedirs(OUTDIR, exist_ok=True)
 
 print(f"[pwd] {BASEDIR}\n[in ] {URLFILE}\n[out] {OUTDIR}\n[log] {LOGCSV}")
@@ -22,51 +34,49 @@ UA = (
     "AppleWebKit/537.36 (KHTML, like Gecko) Chrome Safari"
 )
 
+FETCH_WORKERS = 16     # article pages fetched concurrently
+DOWNLOAD_WORKERS = 16  # image downloads in flight
+MIN_IMAGE_BYTES = 20000  # HEAD Content-Length below this: thumbnail / pixel, skipped
+
 def fetch(url, timeout=25):
-    req = urllib.request.Request(url, headers={"User-Agent": UA})
-    with urllib.request.urlopen(req, timeout=timeout) as r:
-        charset = r.headers.get_content_charset() or "utf-8"
-        return r.read().decode(charset, errors="ignore")
+    """Raw body plus its charset: Content-Type's, else UTF-8 (as the pages were always decoded)."""
+    with open_url(url, headers={"User-Agent": UA}, timeout=timeout) as r:
+        charset = r.headers.get_content_charset()
+        body = r.read()
+    if charset:
+        try:
+            codecs.lookup(charset)
+        except LookupError:  # bogus header
+            charset = None
+    return body, charset or "utf-8"
 
 # ---------- helpers ----------
 IMG_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
-SRCSET_SPLIT = re.compile(r"\s*,\s*")
-CANDIDATE    = re.compile(r"^\s*(\S+)\s+(\d+)(w|x)?\s*$")
+STYLE_URL    = re.compile(r'url\((["\']?)(https?://i\.guim\.co\.uk/[^)]+)\1\)')
+NOSCRIPT_IMG = re.compile(r'<img[^>]+src=["\']([^"\']+)["\']', re.I)
 
 def best_from_srcset(srcset, base_url):
-    """Return the largest candidate URL (by width/x) from a srcset string."""
-    if not srcset:
-        return None
-    best_url, best_size = None, -1
-    for part in SRCSET_SPLIT.split(srcset.strip()):
-        m = CANDIDATE.match(part)
-        if m:
-            u, size = m.group(1), int(m.group(2))
-            if size > best_size:
-                best_size  = size
-                best_url   = urllib.parse.urljoin(base_url, u)
-        else:
-            p = part.strip()
-            if p:
-                return urllib.parse.urljoin(base_url, p)
-    return best_url
+    """Return the largest candidate URL (by width, then x) from a srcset string."""
+    return srcset_best(srcset, base_url)[0]
 
+@functools.lru_cache(maxsize=2048)
 def safe_ext(u: str) -> str:
     ext = os.path.splitext(urllib.parse.urlparse(u).path)[1].lower()
     return ext if ext in IMG_EXTS else ".jpg"
 
+GUARDIAN_CDN = ("http://i.guim.co.uk/", "https://i.guim.co.uk/")
+
 def keep_guardian_cdn(u: str) -> bool:
-    try:
-        return urllib.parse.urlparse(u).netloc.lower().endswith("i.guim.co.uk")
-    except:
-        return False
+    # plain prefix test: cheaper than urlparse for every candidate
+    return u.startswith(GUARDIAN_CDN)
 
+@functools.lru_cache(maxsize=2048)
 def upgrade_guardian_url(url: str, width: int = 2000) -> str:
     """
     If the Guardian image URL is SIGNED (contains &s=...), DO NOT modify it.
     Otherwise (rare, unsigned), it's safe to tweak width/dpr.
     """
-    if "i.guim.co.uk" not in url:
+    if not url.startswith(GUARDIAN_CDN):
         return url
     parsed = urllib.parse.urlparse(url)
     if "s=" in (parsed.query or "").lower():
@@ -78,35 +88,36 @@ def upgrade_guardian_url(url: str, width: int = 2000) -> str:
     new_q = urllib.parse.urlencode({k: v[0] for k, v in q.items()})
     return urllib.parse.urlunparse(parsed._replace(query=new_q))
 
+# start tags that can open a region, and every tag handle_endtag closes
+REGION_TAGS = frozenset({"main", "article", "div", "figure"})
+CLOSED_TAGS = frozenset({"main", "article", "div", "figure", "picture", "noscript"})
+
+def _find(attrs_list, *keys):
+    """Values of keys from an html.parser attrs list (last wins, like dict(attrs))."""
+    found = [None] * len(keys)
+    for k, v in attrs_list:
+        if k in keys:
+            found[keys.index(k)] = v
+    return found
+
 # ---------- HTML parser (article + lightbox, with noscript fallback) ----------
-class GuardianParser(html.parser.HTMLParser):
+class _ImageCollector:
     """
-    Collects image URLs from:
-      - <main><article>… (figures/pictures/imgs inside the article)
-      - the lightbox dialog (id="gu-lightbox", role="dialog")
+    Shared candidate handling for both the lxml and the html.parser back ends.
     Prefers largest candidate from srcset; filters to i.guim.co.uk; preserves signed URLs.
     """
     def __init__(self, base_url: str):
-        super().__init__()
         self.base = base_url
         self.images = []
         self._seen  = set()
 
-        # region state
-        self.in_main = 0
-        self.in_article = 0
-        self.in_lightbox = 0
-        self.in_figure = 0
-        self.in_picture = 0
-        self.in_noscript = 0
-
         # track best candidate inside a <picture>
         self.picture_best = None  # (url, size_hint)
 
     def _consider(self, url: str, size_hint: int = -1):
         if not url:
             return
-        url = urllib.parse.urljoin(self.base, url)
+        url = abs_url(self.base, url)
         if not url.startswith(("http://", "https://")):
             return
         if not keep_guardian_cdn(url):
@@ -117,7 +128,7 @@ class GuardianParser(html.parser.HTMLParser):
             self._seen.add(url)
             self.images.append(url)
 
-    def _pick_from_attrs(self, attrs: dict):
+    def _pick_from_attrs(self, attrs):
         # prefer srcset/data-srcset for largest
         for k in ("srcset", "data-srcset"):
             if attrs.get(k):
@@ -135,33 +146,15 @@ class GuardianParser(html.parser.HTMLParser):
             self._consider(self.picture_best[0], self.picture_best[1])
             self.picture_best = None
 
-    def handle_starttag(self, tag, attrs_list):
-        attrs = dict(attrs_list)
-
-        if tag == "main":
-            self.in_main += 1
-        elif tag == "article" and self.in_main:
-            self.in_article += 1
-        elif tag == "div" and (attrs.get("id") == "gu-lightbox" or attrs.get("role") == "dialog"):
-            self.in_lightbox += 1
-
-        if tag == "figure" and (self.in_article or self.in_lightbox):
-            self.in_figure += 1
-
-        if tag == "picture" and (self.in_figure or self.in_lightbox):
-            self.in_picture += 1
-            self.picture_best = None
-
-        if tag == "noscript" and (self.in_figure or self.in_lightbox):
-            self.in_noscript += 1
-
-        # capture <img>/<source> only inside article figures or lightbox
-        if (self.in_figure or self.in_lightbox) and tag in ("img", "source"):
+    def _collect(self, tag, attrs, in_picture):
+        """Handle an element already known to sit inside an article figure or the lightbox."""
+        # capture <img>/<source>
+        if tag in ("img", "source"):
             u, sz = self._pick_from_attrs(attrs)
             if not u:
                 return
             # if inside <picture>, keep only the best for that picture
-            if self.in_picture:
+            if in_picture:
                 # crude size hint: prefer srcset over src
                 size_hint = 2 if ("srcset" in attrs or "data-srcset" in attrs) else 1
                 if not self.picture_best or size_hint > self.picture_best[1]:
@@ -170,55 +163,153 @@ class GuardianParser(html.parser.HTMLParser):
                 self._consider(u)
 
         # also handle inline styles occasionally used for background-image
-        if (self.in_figure or self.in_lightbox) and "style" in attrs:
-            m = re.search(r'url\((["\']?)(https?://i\.guim\.co\.uk/[^)]+)\1\)', attrs["style"])
+        if "style" in attrs:
+            m = STYLE_URL.search(attrs["style"])
             if m:
                 self._consider(m.group(2))
 
-    def handle_endtag(self, tag):
-        if tag == "picture" and self.in_picture:
-            self._commit_picture_best()
-            self.in_picture -= 1
+    def _collect_noscript(self, txt):
+        # noscript <img src="…"> fallbacks inside figures/lightbox
+        for m in NOSCRIPT_IMG.finditer(txt):
+            self._consider(m.group(1))
+
+class GuardianParser(_ImageCollector, html.parser.HTMLParser):
+    """
+    Collects image URLs from:
+      - <main><article>… (figures/pictures/imgs inside the article)
+      - the lightbox dialog (id="gu-lightbox", role="dialog")
+    Stdlib fallback used when lxml is not installed.
+    """
+    def __init__(self, base_url: str):
+        # charrefs are decoded by the tokenizer, so handle_data sees plain text
+        html.parser.HTMLParser.__init__(self, convert_charrefs=True)
+        _ImageCollector.__init__(self, base_url)
 
-        if tag == "noscript" and self.in_noscript:
-            self.in_noscript -= 1
+        # region state
+        self.in_main = 0
+        self.in_article = 0
+        self.in_lightbox = 0
+        self.in_figure = 0
+        self.in_picture = 0
+        self.in_noscript = 0
+        # div nesting level, plus the levels at which a lightbox div was opened
+        self.div_depth = 0
+        self.lightbox_div_depths = []
 
-        if tag == "figure" and self.in_figure:
-            self.in_figure -= 1
+    def handle_starttag(self, tag, attrs_list):
+        if tag in REGION_TAGS:
+            if tag == "main":
+                self.in_main += 1
+            elif tag == "article" and self.in_main:
+                self.in_article += 1
+            elif tag == "div":
+                self.div_depth += 1
+                div_id, role = _find(attrs_list, "id", "role")
+                if div_id == "gu-lightbox" or role == "dialog":
+                    self.lightbox_div_depths.append(self.div_depth)
+                    self.in_lightbox += 1
+            elif tag == "figure" and (self.in_article or self.in_lightbox):
+                self.in_figure += 1
+
+        # everything below only applies inside article figures or the lightbox
+        if not (self.in_figure or self.in_lightbox):
+            return
 
-        if tag == "article" and self.in_article:
-            self.in_article -= 1
+        if tag == "picture":
+            self.in_picture += 1
+            self.picture_best = None
+        elif tag == "noscript":
+            self.in_noscript += 1
 
-        if tag == "main" and self.in_main:
-            self.in_main -= 1
+        # only the few tags inside a region pay for a full attribute dict
+        self._collect(tag, dict(attrs_list), self.in_picture)
 
-        if tag == "div" and self.in_lightbox:
-            self.in_lightbox -= 1
+    def handle_endtag(self, tag):
+        if tag not in CLOSED_TAGS:
+            return
+        # tags are mutually exclusive, so one elif chain covers every region
+        if tag == "picture":
+            if self.in_picture:
+                self._commit_picture_best()
+                self.in_picture -= 1
+        elif tag == "noscript":
+            if self.in_noscript:
+                self.in_noscript -= 1
+        elif tag == "figure":
+            if self.in_figure:
+                self.in_figure -= 1
+        elif tag == "article":
+            if self.in_article:
+                self.in_article -= 1
+        elif tag == "main":
+            if self.in_main:
+                self.in_main -= 1
+        elif tag == "div":
+            # leave the lightbox at its own </div>, not at a nested one
+            if self.div_depth:
+                if self.lightbox_div_depths and self.lightbox_div_depths[-1] == self.div_depth:
+                    self.lightbox_div_depths.pop()
+                    self.in_lightbox -= 1
+                self.div_depth -= 1
 
     def handle_data(self, data):
-        # noscript <img src="…"> fallbacks inside figures/lightbox
         if (self.in_figure or self.in_lightbox) and self.in_noscript and data.strip():
-            txt = html.unescape(data)
-            for m in re.finditer(r'<img[^>]+src=["\']([^"\']+)["\']', txt, re.I):
-                self._consider(m.group(1))
+            self._collect_noscript(data)
+
+# same regions as GuardianParser, selected in one libxml2 pass (document order)
+_REGION_NODES = '/descendant-or-self::*[self::img or self::source or self::noscript or @style]'
+GUARDIAN_XPATH = (
+    '//main//article//figure' + _REGION_NODES +
+    ' | //div[@id="gu-lightbox" or @role="dialog"]' + _REGION_NODES
+)
 
-def extract_guardian_images(page_url: str, html_text: str):
+def _extract_lxml(page_url: str, body: bytes, charset):
+    c = _ImageCollector(page_url)
+    # libxml2 decodes the bytes itself, no full str copy of the page
+    try:
+        parser = lxml_html.HTMLParser(encoding=charset, huge_tree=True)
+    except LookupError:  # a codec name Python knows but libxml2 does not
+        parser = lxml_html.HTMLParser(encoding="utf-8", huge_tree=True)
+    tree = lxml_html.document_fromstring(body, parser=parser)
+    picture = None
+    for el in tree.xpath(GUARDIAN_XPATH):
+        pic = next(el.iterancestors("picture"), None)
+        if pic is not picture:
+            # left the previous <picture>: emit its best candidate
+            c._commit_picture_best()
+            picture = pic
+        if el.tag == "noscript":
+            txt = el.text_content()
+            if txt.strip():
+                c._collect_noscript(txt)
+            continue
+        c._collect(el.tag, el.attrib, pic is not None)
+    c._commit_picture_best()
+    return c.images
+
+def extract_guardian_images(page_url: str, body: bytes, charset: str = "utf-8"):
+    if lxml_html is not None:
+        return _extract_lxml(page_url, body, charset)
     p = GuardianParser(page_url)
-    p.feed(html_text)
+    p.feed(body.decode(charset, errors="ignore"))
     return p.images
 
 # ---------- IO ----------
-def save_image(url: str, idx: int) -> str:
-    name = f"guardian_{idx}{safe_ext(url)}"
-    path = os.path.join(OUTDIR, name)
+def save_image(url: str, path: str, cached):
+    """
+    Download worker: url's (ETag, Last-Modified) validators, None if the probe
+    rejected it, or False if the download failed.
+    """
+    def refetch(e):
+        print(f"[!] cached copy unusable, downloading again: {url} :: {e}")
     try:
-        req = urllib.request.Request(url, headers={"User-Agent": UA})
-        with urllib.request.urlopen(req, timeout=30) as r, open(path, "wb") as f:
-            f.write(r.read())
-        print(f"[OK] {name} <- {url}")
+        return download(url, path, cached, {"User-Agent": UA}, MIN_IMAGE_BYTES, refetch)
+    except Skipped as e:
+        print(f"[-]  {url} :: skipped, {e}")
+        return None
     except Exception as e:
         print(f"[x]  {url} :: {e}")
-    return name
+        return False
 
 def load_urls(path: str):
     if not os.path.isfile(path):
@@ -228,43 +319,90 @@ def load_urls(path: str):
         return [u.strip() for u in f if u.strip() and "theguardian.com" in u]
 
 # ---------- main ----------
+def _extract_or_empty(url: str):
+    """Worker for the page pool: fetch + parse, never raises."""
+    try:
+        fetched = fetch(url)
+    except Exception as e:
+        print(f"[!] fetch failed: {url} :: {e}")
+        return []
+    try:
+        return extract_guardian_images(url, *fetched)
+    except Exception as e:  # e.g. lxml's "Document is empty"
+        print(f"[!] parse failed: {url} :: {e}")
+        return []
+
+def finish_page(results, next_idx: int, downloads: Downloads):
+    """
+    Name this page's downloads guardian_<n><ext>, sequential in URL order.
+    Skipped images take no number; failed ones keep theirs, as they always did.
+    Repeats of an image handled for an earlier page reuse its name.
+    """
+    names = []
+    for url, tmp, validators in results:
+        if validators is REPEAT:
+            if url in downloads.seen:
+                names.append(downloads.seen[url])
+            continue
+        if validators is None:
+            continue
+        name = f"guardian_{next_idx}{safe_ext(url)}"
+        next_idx += 1
+        if validators:
+            downloads.keep(url, tmp, validators, name)
+            print(f"[OK] {name} <- {url}")
+        else:
+            downloads.seen[url] = name
+        names.append(name)
+    return names, next_idx
+
 def main():
     urls = load_urls(URLFILE)
     if not urls:
         print("[!] No Guardian URLs found in file."); return
 
-    global_idx = 0
-    rows = []
+    global_idx = 1
     max_imgs_any = 0
 
-    for u in urls:
-        print(f"\n[fetch] {u}")
-        try:
-            html_text = fetch(u)
-        except Exception as e:
-            print(f"[!] fetch failed: {e}")
-            rows.append([u, 0])
-            continue
-
-        img_urls = extract_guardian_images(u, html_text)
-        print(f"[info] images found: {len(img_urls)}")
-
-        names = []
-        for img_u in img_urls:
-            global_idx += 1
-            names.append(save_image(img_u, global_idx))
-
-        max_imgs_any = max(max_imgs_any, len(names))
-        rows.append([u, len(names), *names])
-
-    # write CSV log (pad columns)
+    # pages are fetched and parsed concurrently (results come back in URL
+    # order) while the images of already-parsed pages download in a second
+    # pool; each image URL is downloaded once per run and later pages log its name
+    cache = ValidatorCache(CACHEDB)
+
+    def flush(block):
+        # rows go out in URL order, as soon as a page and all pages before it are done
+        nonlocal global_idx, max_imgs_any
+        for u, results in downloads.finished(block):
+            names, global_idx = finish_page(results, global_idx, downloads)
+            max_imgs_any = max(max_imgs_any, len(names))
+            rows.writerow([u, len(names), *names])
+
+    spool = LOGCSV + ".part"  # unpadded rows, written page by page
+    with open(spool, "w", newline="", encoding="utf-8") as part, \
+         ThreadPoolExecutor(FETCH_WORKERS) as page_pool, \
+         ThreadPoolExecutor(DOWNLOAD_WORKERS) as dl_pool:
+        rows = csv.writer(part)
+        downloads = Downloads(dl_pool, cache, OUTDIR, "guardian", save_image)
+        for u, img_urls in zip(urls, page_pool.map(_extract_or_empty, urls)):
+            print(f"\n[fetch] {u}")
+            print(f"[info] images found: {len(img_urls)}")
+            downloads.submit(u, img_urls)
+            flush(block=False)
+        flush(block=True)
+    close_all()
+    cache.close()
+
+    # write CSV log: the header width is only known now, so rows are copied
+    # over from the spool and padded lazily
     header = ["URL", "Number of Images"] + [f"Image {i} Name" for i in range(1, max_imgs_any + 1)]
-    with open(LOGCSV, "w", newline="", encoding="utf-8") as f:
+    width = len(header)
+    with open(spool, "r", newline="", encoding="utf-8") as part, \
+         open(LOGCSV, "w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
         w.writerow(header)
-        for r in rows:
-            r = r + [""] * (2 + max_imgs_any - len(r))
-            w.writerow(r)
+        for r in csv.reader(part):
+            w.writerow(itertools.chain(r, itertools.repeat("", width - len(r))))
+    os.remove(spool)
 
     print(f"\n[done] wrote log: {LOGCSV}")
 